@@ -1,239 +1,676 @@
 import os
+import re
 import sqlite3
 import logging
-import json
+import logging.handlers
+import queue
 import urllib.parse
 import time
 import asyncio
+import threading
+import functools
+import weakref
+import contextlib
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Dict, Any
+from cachetools import LRUCache, TTLCache
+import orjson
+
+try:
+    import uvloop
+except ImportError:  # uvloop недоступен на Windows
+    uvloop = None
 from dotenv import load_dotenv
-from aiohttp import web
-import aiohttp_cors
 
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # Загрузка переменных окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: уровень из LOG_LEVEL, запись в файл и консоль
+# выполняется фоновым потоком QueueListener, а не потоком обработчика
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.FileHandler('bot.log'),
+    logging.StreamHandler()
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+log_listener = logging.handlers.QueueListener(queue.SimpleQueue(), *_log_handlers)
+log_listener.start()
+logging.root.addHandler(logging.handlers.QueueHandler(log_listener.queue))
+logging.root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # Конфигурация из переменных окружения
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_PATH = os.getenv("DATABASE_PATH", "finance_tracker.db")
+WEBAPP_URL = os.getenv("WEBAPP_URL", "https://your-username.github.io/your-repo-name/webapp.html")
+
+# Максимальное число записей в кэшах баланса, статистики и состояний диалогов
+CACHE_MAX_USERS = 10_000
+
+# Настройки каждого соединения с SQLite: WAL, один fsync на транзакцию,
+# временные таблицы в памяти, 64 МБ кэша страниц и 256 МБ mmap.
+# analysis_limit ограничивает ANALYZE выборкой строк, чтобы он не сканировал большие таблицы
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-65536",
+    "mmap_size=268435456",
+    "foreign_keys=ON",
+    "analysis_limit=400",
+)
+
+# Минимальная версия SQLite: оконные функции в запросах статистики появились в 3.25
+MIN_SQLITE_VERSION = (3, 25, 0)
+
+# Число соединений только для чтения; запись идёт через одно соединение
+READER_CONNECTIONS = 3
+
+# Максимальная сумма одной транзакции, рубли
+MAX_AMOUNT = 1_000_000
+
+# Время жизни незавершённого диалога пользователя, секунды
+USER_STATE_TTL = 3600
+
+# Время жизни кэша полной статистики пользователя, секунды. Запись транзакции
+# сбрасывает кэш сразу, поэтому TTL лишь ограничивает задержку при смене дня и недели
+USER_STATS_TTL = 30.0
+
+# Исходящие сообщения: повторы при RetryAfter. У второстепенных ответов
+# (статистика, помощь) повторов меньше, чтобы они не задерживали интерактивные
+SEND_MAX_RETRIES = 3
+LOW_PRIORITY_RETRIES = 1
+
+# Пул HTTP/2-соединений к Bot API: TCP+TLS переиспользуются между запросами
+TELEGRAM_POOL_SIZE = 64
+
+# Границы текущих периодов: (начало следующего дня, начало дня, начало недели,
+# ключ месяца "ГГГГ-ММ"). Пересчитываются только при смене дня
+_PERIOD_CACHE: tuple[float, int, int, str] = (0.0, 0, 0, "")
+
+def _current_periods() -> tuple[float, int, int, str]:
+    """Границы текущего дня, недели и месяца"""
+    global _PERIOD_CACHE
+    if time.time() >= _PERIOD_CACHE[0]:
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        _PERIOD_CACHE = (
+            (today + timedelta(days=1)).timestamp(),
+            int(today.timestamp()),
+            int((today - timedelta(days=today.weekday())).timestamp()),
+            f"{today.year:04d}-{today.month:02d}",
+        )
+    return _PERIOD_CACHE
+
+def current_month_key() -> str:
+    """Ключ текущего месяца для monthly_rollup"""
+    return _current_periods()[3]
+
+def now_stamp() -> tuple[int, str]:
+    """Текущий момент: unix time и строка даты для столбца date"""
+    ts = int(time.time())
+    return ts, datetime.fromtimestamp(ts).isoformat(sep=" ", timespec="seconds")
+
+def day_start_ts() -> int:
+    """Начало текущего дня, unix time"""
+    return _current_periods()[1]
+
+def week_start_ts() -> int:
+    """Начало текущей недели (понедельник), unix time"""
+    return _current_periods()[2]
+
+# Баланс, статистика за день/неделю/месяц и последние транзакции одним запросом;
+# первый столбец указывает, к какой части результата относится строка
+USER_STATS_SQL = '''
+    WITH week AS (
+        -- Один проход по строкам недели даёт и недельные, и дневные суммы.
+        -- CTE используется дважды, поэтому SQLite 3.35+ материализует его сам
+        SELECT type, category,
+               SUM(CASE WHEN ts >= :day_start THEN amount_kop END) AS day_kop,
+               SUM(amount_kop) AS week_kop
+        FROM transactions WHERE user_id = :user_id AND ts >= :week_start
+        GROUP BY type, category
+    )
+    SELECT 'balance', NULL, NULL, balance_kop / 100.0, NULL, NULL, NULL, NULL
+    FROM user_totals WHERE user_id = :user_id
+    UNION ALL
+    SELECT 'daily', type, category, day_kop / 100.0,
+           SUM(day_kop) OVER (PARTITION BY type) / 100.0, NULL, NULL, NULL
+    FROM week WHERE day_kop IS NOT NULL
+    UNION ALL
+    SELECT 'weekly', type, category, week_kop / 100.0,
+           SUM(week_kop) OVER (PARTITION BY type) / 100.0, NULL, NULL, NULL
+    FROM week
+    UNION ALL
+    SELECT 'monthly', type, category, total_kop / 100.0,
+           SUM(total_kop) OVER (PARTITION BY type) / 100.0, NULL, NULL, NULL
+    FROM monthly_rollup WHERE user_id = :user_id AND month_key = :month_key
+    UNION ALL
+    SELECT * FROM (
+        SELECT 'recent', type, category, amount_kop / 100.0, NULL, description, date, ts
+        FROM transactions WHERE user_id = :user_id
+        ORDER BY ts DESC LIMIT :limit
+    )
+'''
+
+# Запросы горячего пути. Тексты SQL неизменны, поэтому sqlite3 берёт
+# подготовленные выражения из кэша соединения (cached_statements), а не разбирает их заново
+INSERT_TRANSACTION_SQL = '''
+    INSERT INTO transactions (user_id, type, amount_kop, category, description, date, ts)
+    VALUES (:user_id, :type, :amount_kop, :category, :description, :date, :ts)
+'''
+
+UPSERT_USER_TOTALS_SQL = '''
+    INSERT INTO user_totals (user_id, balance_kop)
+    VALUES (:user_id, :delta)
+    ON CONFLICT(user_id) DO UPDATE SET
+        balance_kop = balance_kop + excluded.balance_kop
+'''
+
+BALANCE_SQL = "SELECT balance_kop / 100.0 FROM user_totals WHERE user_id = ?"
+
+HAS_TRANSACTIONS_SQL = "SELECT 1 FROM user_totals WHERE user_id = ?"
+
+# Статистика с начала дня или недели; итоги по типу считает оконная функция
+PERIOD_STATS_SQL = '''
+    SELECT type, category, SUM(amount_kop) / 100.0,
+           SUM(SUM(amount_kop)) OVER (PARTITION BY type) / 100.0
+    FROM transactions
+    WHERE user_id = ? AND ts >= ?
+    GROUP BY type, category
+'''
+
+MONTHLY_STATS_SQL = '''
+    SELECT type, category, total_kop / 100.0,
+           SUM(total_kop) OVER (PARTITION BY type) / 100.0
+    FROM monthly_rollup
+    WHERE user_id = ? AND month_key = ?
+'''
+
+SAVE_USER_STATE_SQL = '''
+    INSERT INTO user_state (user_id, state, category, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        state = excluded.state,
+        category = excluded.category,
+        updated_at = excluded.updated_at
+'''
+
+LOAD_USER_STATE_SQL = '''
+    SELECT state, category FROM user_state
+    WHERE user_id = ? AND updated_at >= ?
+'''
+
+# Схема таблицы транзакций; суммы хранятся в копейках.
+# CHECK гарантирует, что статистика встречает только типы income и expense
+TRANSACTIONS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        type TEXT NOT NULL CHECK (type IN ('income', 'expense')),
+        amount_kop INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        description TEXT,
+        date TEXT NOT NULL,
+        ts INTEGER NOT NULL
+    )
+'''
 
 class FinanceTracker:
     def __init__(self, db_path: str = None):
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise RuntimeError(
+                f"Нужен SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} или новее, "
+                f"установлен {sqlite3.sqlite_version}"
+            )
         self.db_path = db_path or DATABASE_PATH
+        # Одно долгоживущее соединение для записи вместо connect/close на каждый вызов
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                                     cached_statements=256)
+        self._lock = threading.Lock()
+        # LRU-кэши агрегатов, сбрасываются при добавлении транзакции
+        self._balance_cache: OrderedDict[int, float] = OrderedDict()
+        self._stats_cache: OrderedDict[tuple[int, str], Dict[str, Any]] = OrderedDict()
+        # Полная статистика для веб-приложения: user_id -> (момент устаревания, статистика)
+        self._user_stats_cache: OrderedDict[int, tuple[float, Dict[str, Any]]] = OrderedDict()
+        self._configure_connection(self._conn)
         self.init_database()
+        # Номер последней записи: результат чтения кладётся в кэш,
+        # только если за время запроса ничего не записывалось
+        self._write_seq = 0
+        # Читатели не ждут писателя: в режиме WAL они видят последний COMMIT
+        self._readers: queue.SimpleQueue[sqlite3.Connection] = queue.SimpleQueue()
+        for _ in range(READER_CONNECTIONS):
+            reader = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                                     cached_statements=256)
+            self._configure_connection(reader)
+            reader.execute("PRAGMA query_only=ON")
+            self._readers.put(reader)
+    
+    @staticmethod
+    def _configure_connection(conn: sqlite3.Connection):
+        """Применение PRAGMA-настроек к соединению"""
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(f"PRAGMA {pragma}")
+    
+    @staticmethod
+    def _cache_get(cache: OrderedDict, key):
+        """Чтение из LRU-кэша (вызывается под self._lock)"""
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+    
+    @staticmethod
+    def _cache_put(cache: OrderedDict, key, value):
+        """Запись в LRU-кэш с вытеснением самых старых записей"""
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > CACHE_MAX_USERS:
+            cache.popitem(last=False)
+    
+    def _invalidate_locked(self, user_id: int, *month_keys: str):
+        """Сброс кэшей пользователя при записи (вызывается под self._lock)"""
+        self._write_seq += 1
+        self._balance_cache.pop(user_id, None)
+        self._user_stats_cache.pop(user_id, None)
+        for month_key in month_keys:
+            self._stats_cache.pop((user_id, month_key), None)
+    
+    def _begin_read(self) -> int:
+        """Номер последней записи перед чтением, для проверки кэша"""
+        with self._lock:
+            return self._write_seq
+    
+    @contextlib.contextmanager
+    def _reader(self):
+        """Соединение для чтения из пула; ждёт, если все заняты"""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+    
+    def _has_column(self, table: str, column: str) -> bool:
+        """Проверка наличия столбца в таблице (вызывается под self._lock)"""
+        return any(row[1] == column for row in self._conn.execute(f"PRAGMA table_info({table})"))
     
     def init_database(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                type TEXT NOT NULL,
-                amount REAL NOT NULL,
-                category TEXT NOT NULL,
-                description TEXT,
-                date TEXT NOT NULL
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-    
-    def add_transaction(self, user_id: int, transaction_type: str, amount: float, 
-                       category: str, description: str = ""):
-        """Добавление транзакции с валидацией"""
+        with self._lock:
+            self._conn.execute(TRANSACTIONS_TABLE_SQL.format(table="transactions"))
+
+            # Миграция: время транзакции как INTEGER (unix time) для быстрых сравнений.
+            # Столбец и его заполнение появляются одной транзакцией
+            if not self._has_column("transactions", "ts"):
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.execute("ALTER TABLE transactions ADD COLUMN ts INTEGER")
+                    self._conn.execute('''
+                        UPDATE transactions SET ts = CAST(strftime('%s', date, 'utc') AS INTEGER)
+                        WHERE ts IS NULL
+                    ''')
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+
+            # Миграция: суммы в копейках (INTEGER) вместо REAL
+            if not self._has_column("transactions", "amount_kop"):
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.execute(TRANSACTIONS_TABLE_SQL.format(table="transactions_new"))
+                    # Как и раньше при подсчёте баланса, любой тип кроме income считается расходом
+                    self._conn.execute('''
+                        INSERT INTO transactions_new (id, user_id, type, amount_kop, category, description, date, ts)
+                        SELECT id, user_id, CASE WHEN type = 'income' THEN 'income' ELSE 'expense' END,
+                               CAST(ROUND(amount * 100) AS INTEGER), category, description, date,
+                               -- ts NULL остаётся после прерванной миграции или у нераспознанной даты
+                               COALESCE(ts, CAST(strftime('%s', date, 'utc') AS INTEGER), 0)
+                        FROM transactions
+                    ''')
+                    self._conn.execute("DROP TABLE transactions")
+                    self._conn.execute("ALTER TABLE transactions_new RENAME TO transactions")
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+
+            # Покрывающий индекс для статистики по периодам; он же даёт упорядоченный
+            # по ts обход для последних транзакций. Баланс читается из user_totals,
+            # поэтому отдельный индекс по (user_id, type) не нужен
+            self._conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_tx_user_ts
+                ON transactions (user_id, ts, type, category, amount_kop)
+            ''')
+
+            # Денормализованный баланс пользователя, обновляется при каждой записи
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_totals (
+                    user_id INTEGER PRIMARY KEY,
+                    balance_kop INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
+            # Помесячная сводка по категориям (аналог materialized view),
+            # поддерживается триггером при каждой вставке в transactions
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS monthly_rollup (
+                    user_id INTEGER NOT NULL,
+                    month_key TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    total_kop INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, month_key, type, category)
+                )
+            ''')
+            self._conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_rollup_ins AFTER INSERT ON transactions
+                BEGIN
+                    INSERT INTO monthly_rollup (user_id, month_key, type, category, total_kop)
+                    VALUES (NEW.user_id, substr(NEW.date, 1, 7), NEW.type, NEW.category, NEW.amount_kop)
+                    ON CONFLICT(user_id, month_key, type, category) DO UPDATE SET
+                        total_kop = total_kop + excluded.total_kop;
+                END
+            ''')
+
+            # Состояния диалогов, переживают перезапуск бота
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_state (
+                    user_id INTEGER PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    category TEXT,
+                    updated_at INTEGER NOT NULL
+                )
+            ''')
+
+            # Заполняем итоги для уже существующих транзакций
+            self._conn.execute('''
+                INSERT INTO user_totals (user_id, balance_kop)
+                SELECT user_id, SUM(CASE WHEN type = 'income' THEN amount_kop ELSE -amount_kop END)
+                FROM transactions
+                WHERE NOT EXISTS (SELECT 1 FROM user_totals)
+                GROUP BY user_id
+            ''')
+            self._conn.execute('''
+                INSERT INTO monthly_rollup (user_id, month_key, type, category, total_kop)
+                SELECT user_id, substr(date, 1, 7), type, category, SUM(amount_kop)
+                FROM transactions
+                WHERE NOT EXISTS (SELECT 1 FROM monthly_rollup)
+                GROUP BY user_id, substr(date, 1, 7), type, category
+            ''')
+
+            # Статистика для планировщика запросов собирается один раз для новой базы,
+            # дальше её обновляет PRAGMA optimize при закрытии
+            if self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            ).fetchone() is None:
+                self._conn.execute("ANALYZE")
+
+    def _build_row(self, user_id: int, transaction_type: str, amount: float,
+                   category: str, description: str, stamp: tuple[int, str] = None) -> Dict[str, Any]:
+        """Валидация и подготовка строки транзакции"""
         # ✅ Добавлена валидация
         if amount <= 0:
             raise ValueError("Сумма должна быть положительной")
-        if amount > 1000000:  # Лимит на сумму
+        if amount > MAX_AMOUNT:
             raise ValueError("Сумма слишком большая")
         if transaction_type not in ['income', 'expense']:
             raise ValueError("Неверный тип транзакции")
         
-        logger.info(f"Добавление транзакции: user_id={user_id}, type={transaction_type}, amount={amount}, category={category}")
+        amount_kop = int(round(amount * 100))
+        if amount_kop == 0:
+            raise ValueError("Сумма должна быть положительной")
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        logger.info("Добавление транзакции: user_id=%s, type=%s, amount=%s, category=%s",
+                    user_id, transaction_type, amount, category)
         
-        date_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        ts, date_str = stamp or now_stamp()
+        row = {
+            "user_id": user_id,
+            "type": transaction_type,
+            "amount_kop": amount_kop,
+            "category": category,
+            "description": description,
+            "date": date_str,
+            "ts": ts,
+            "delta": amount_kop if transaction_type == "income" else -amount_kop,
+            "month_key": date_str[:7],
+        }
+        return row
+    
+    def add_transaction(self, user_id: int, transaction_type: str, amount: float, 
+                       category: str, description: str = ""):
+        """Добавление транзакции с валидацией"""
+        row = self._build_row(user_id, transaction_type, amount, category, description)
         
-        cursor.execute('''
-            INSERT INTO transactions (user_id, type, amount, category, description, date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, transaction_type, amount, category, description, date_str))
+        with self._lock:
+            self._invalidate_locked(user_id, row["month_key"])
+            try:
+                self._commit_rows_locked([row])
+            except Exception:
+                self._invalidate_locked(user_id, row["month_key"])
+                raise
         
-        conn.commit()
-        conn.close()
-        logger.info(f"Транзакция успешно добавлена для пользователя {user_id}")
+        logger.info("Транзакция успешно добавлена для пользователя %s", user_id)
     
-    def get_user_balance(self, user_id: int) -> float:
-        """Получение баланса пользователя"""
-        logger.debug(f"Получение баланса для пользователя {user_id}")
+    def add_transaction_and_get_stats(self, user_id: int, transaction_type: str, amount: float,
+                                      category: str, description: str = "") -> Dict[str, Any]:
+        """Добавление транзакции и чтение статистики в одной транзакции SQLite"""
+        row = self._build_row(user_id, transaction_type, amount, category, description)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT type, SUM(amount) FROM transactions 
-            WHERE user_id = ? GROUP BY type
-        ''', (user_id,))
+        with self._lock:
+            self._invalidate_locked(user_id, row["month_key"])
+            
+            # Вставка и чтение атомарны: статистика всегда видит только что записанную строку
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_rows_locked([row])
+                month_key = current_month_key()
+                result = self._fetch_stats(self._conn, user_id, month_key)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                self._invalidate_locked(user_id, row["month_key"])
+                raise
+            self._cache_stats_locked(user_id, month_key, result)
         
-        results = cursor.fetchall()
-        conn.close()
+        logger.info("Транзакция успешно добавлена для пользователя %s", user_id)
+        return result
+    
+    def add_transactions_bulk(self, user_id: int, transactions: list):
+        """Пакетное добавление транзакций одной транзакцией SQLite"""
+        # Сначала валидируем весь пакет, чтобы не записать его частично.
+        # Время фиксируется один раз: пакет синхронизации датируется моментом приёма
+        stamp = now_stamp()
+        rows = [
+            self._build_row(user_id, tx['type'], tx['amount'], tx['category'], tx.get('description', ''), stamp)
+            for tx in transactions
+        ]
         
-        balance = 0
-        for transaction_type, amount in results:
-            if transaction_type == "income":
-                balance += amount
-            else:
-                balance -= amount
+        month_keys = {row["month_key"] for row in rows}
+        with self._lock:
+            self._invalidate_locked(user_id, *month_keys)
+            try:
+                self._commit_rows_locked(rows)
+            except Exception:
+                self._invalidate_locked(user_id, *month_keys)
+                raise
         
-        logger.debug(f"Баланс пользователя {user_id}: {balance}")
-        return balance
+        logger.info("Пакет из %d транзакций добавлен для пользователя %s", len(rows), user_id)
     
-    def get_daily_stats(self, user_id: int) -> Dict[str, Any]:
-        """Получение статистики за день"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Получаем текущую дату
-        today_str = datetime.now().strftime("%Y-%m-%d")
+    def _write_rows_locked(self, rows: list):
+        """Запись строк в уже открытой транзакции SQLite (вызывается под self._lock)"""
+        self._conn.executemany(INSERT_TRANSACTION_SQL, rows)
+        self._conn.executemany(UPSERT_USER_TOTALS_SQL, rows)
+    
+    def _commit_rows_locked(self, rows: list):
+        """Запись строк отдельной транзакцией SQLite (вызывается под self._lock)"""
+        # Транзакции и итоги пишутся атомарно
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_rows_locked(rows)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+    
+    def close(self):
+        """Обновление статистики планировщика и закрытие соединений"""
+        with self._lock:
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
+            for _ in range(READER_CONNECTIONS):
+                self._readers.get().close()
+    
+    def get_user_balance(self, user_id: int) -> float:
+        """Получение баланса пользователя"""
+        logger.debug("Получение баланса для пользователя %s", user_id)
         
-        cursor.execute('''
-            SELECT type, category, SUM(amount) FROM transactions 
-            WHERE user_id = ? AND date(date) = ? 
-            GROUP BY type, category
-        ''', (user_id, today_str))
+        with self._lock:
+            balance = self._cache_get(self._balance_cache, user_id)
+        if balance is None:
+            seq = self._begin_read()
+            with self._reader() as conn:
+                row = conn.execute(BALANCE_SQL, (user_id,)).fetchone()
+            balance = row[0] if row else 0
+            with self._lock:
+                if self._write_seq == seq:
+                    self._cache_put(self._balance_cache, user_id, balance)
         
-        results = cursor.fetchall()
-        conn.close()
+        logger.debug("Баланс пользователя %s: %s", user_id, balance)
+        return balance
+    
+    def _aggregate(self, sql: str, params: tuple) -> Dict[str, Any]:
+        """Статистика по категориям из строк (тип, категория, сумма, итог по типу)"""
+        with self._reader() as conn:
+            results = conn.execute(sql, params).fetchall()
         
         stats = {"income": {}, "expense": {}, "total_income": 0, "total_expense": 0}
         
-        for transaction_type, category, amount in results:
-            if transaction_type == "income":
-                stats["income"][category] = amount
-                stats["total_income"] += amount
-            else:
-                stats["expense"][category] = amount
-                stats["total_expense"] += amount
+        for transaction_type, category, amount, total in results:
+            stats[transaction_type][category] = amount
+            stats[f"total_{transaction_type}"] = total
         
         return stats
     
+    def get_daily_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получение статистики за день"""
+        return self._aggregate(PERIOD_STATS_SQL, (user_id, day_start_ts()))
+    
     def get_weekly_stats(self, user_id: int) -> Dict[str, Any]:
         """Получение статистики за неделю"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self._aggregate(PERIOD_STATS_SQL, (user_id, week_start_ts()))
+    
+    def get_monthly_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получение статистики за месяц"""
+        month_key = current_month_key()
         
-        # Получаем дату начала недели (понедельник)
-        today = datetime.now()
-        week_start = today - timedelta(days=today.weekday())
-        week_start_str = week_start.strftime("%Y-%m-%d")
+        with self._lock:
+            stats = self._cache_get(self._stats_cache, (user_id, month_key))
+        if stats is not None:
+            return stats
         
-        cursor.execute('''
-            SELECT type, category, SUM(amount) FROM transactions 
-            WHERE user_id = ? AND date >= ? 
-            GROUP BY type, category
-        ''', (user_id, week_start_str))
+        seq = self._begin_read()
+        stats = self._aggregate(MONTHLY_STATS_SQL, (user_id, month_key))
         
-        results = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            if self._write_seq == seq:
+                self._cache_put(self._stats_cache, (user_id, month_key), stats)
         
-        stats = {"income": {}, "expense": {}, "total_income": 0, "total_expense": 0}
+        return stats
+    
+    def save_user_state(self, user_id: int, state: str, category: str = None):
+        """Сохранение состояния диалога пользователя"""
+        with self._lock:
+            self._conn.execute(SAVE_USER_STATE_SQL, (user_id, state, category, int(time.time())))
+    
+    def load_user_state(self, user_id: int, max_age: int = USER_STATE_TTL) -> Dict[str, Any]:
+        """Загрузка состояния диалога пользователя, если оно не устарело"""
+        with self._reader() as conn:
+            row = conn.execute(LOAD_USER_STATE_SQL, (user_id, int(time.time()) - max_age)).fetchone()
         
-        for transaction_type, category, amount in results:
-            if transaction_type == "income":
-                stats["income"][category] = amount
-                stats["total_income"] += amount
-            else:
-                stats["expense"][category] = amount
-                stats["total_expense"] += amount
+        if row is None:
+            return None
         
-        return stats
+        state, category = row
+        return {"state": state, "category": category} if category else {"state": state}
     
-    def get_monthly_stats(self, user_id: int) -> Dict[str, Any]:
-        """Получение статистики за месяц"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получение полной статистики пользователя"""
+        logger.debug("Получение полной статистики для пользователя %s", user_id)
         
-        month_start = datetime.now().replace(day=1).strftime("%Y-%m-%d")
+        with self._lock:
+            cached = self._cache_get(self._user_stats_cache, user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
         
-        cursor.execute('''
-            SELECT type, category, SUM(amount) FROM transactions 
-            WHERE user_id = ? AND date >= ? 
-            GROUP BY type, category
-        ''', (user_id, month_start))
+        month_key = current_month_key()
+        seq = self._begin_read()
+        with self._reader() as conn:
+            result = self._fetch_stats(conn, user_id, month_key)
+        with self._lock:
+            if self._write_seq == seq:
+                self._cache_stats_locked(user_id, month_key, result)
         
-        results = cursor.fetchall()
-        conn.close()
+        logger.debug("Статистика пользователя %s: balance=%s, transactions_count=%d",
+                     user_id, result['balance'], len(result['recentTransactions']))
+        return result
+    
+    def _cache_stats_locked(self, user_id: int, month_key: str, result: Dict[str, Any]):
+        """Сохранение полной статистики и заодно баланса и месяца в кэшах (вызывается под self._lock)"""
+        self._cache_put(self._balance_cache, user_id, result['balance'])
+        self._cache_put(self._stats_cache, (user_id, month_key), result['monthlyStats'])
+        self._cache_put(self._user_stats_cache, user_id, (time.monotonic() + USER_STATS_TTL, result))
+    
+    @staticmethod
+    def _fetch_stats(conn: sqlite3.Connection, user_id: int, month_key: str) -> Dict[str, Any]:
+        """Чтение полной статистики одним запросом"""
+        params = {
+            "user_id": user_id,
+            "day_start": day_start_ts(),
+            "week_start": week_start_ts(),
+            "month_key": month_key,
+            "limit": 10,
+        }
         
-        stats = {"income": {}, "expense": {}, "total_income": 0, "total_expense": 0}
+        # Дешёвая проверка по первичному ключу избавляет новых пользователей от тяжёлого запроса
+        has_transactions = conn.execute(HAS_TRANSACTIONS_SQL, (user_id,)).fetchone() is not None
+        rows = conn.execute(USER_STATS_SQL, params).fetchall() if has_transactions else []
         
-        for transaction_type, category, amount in results:
-            if transaction_type == "income":
-                stats["income"][category] = amount
-                stats["total_income"] += amount
+        balance = 0
+        periods = {
+            period: {"income": {}, "expense": {}, "total_income": 0, "total_expense": 0}
+            for period in ("daily", "weekly", "monthly")
+        }
+        recent = []
+        for kind, transaction_type, category, amount, total, description, date, ts in rows:
+            if kind == "balance":
+                balance = amount
+            elif kind == "recent":
+                recent.append((ts, {
+                    'type': transaction_type,
+                    'amount': amount,
+                    'category': category,
+                    'description': description,
+                    'date': date
+                }))
             else:
-                stats["expense"][category] = amount
-                stats["total_expense"] += amount
-        
-        return stats
-    
-    def get_user_transactions(self, user_id: int, limit: int = 50) -> list:
-        """Получение последних транзакций пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT type, amount, category, description, date 
-            FROM transactions 
-            WHERE user_id = ? 
-            ORDER BY date DESC 
-            LIMIT ?
-        ''', (user_id, limit))
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        transactions = []
-        for row in results:
-            transactions.append({
-                'type': row[0],
-                'amount': row[1],
-                'category': row[2],
-                'description': row[3],
-                'date': row[4]
-            })
-        
-        return transactions
-
-    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
-        """Получение полной статистики пользователя"""
-        logger.info(f"Получение полной статистики для пользователя {user_id}")
+                stats = periods[kind]
+                stats[transaction_type][category] = amount
+                stats[f"total_{transaction_type}"] = total
         
-        balance = self.get_user_balance(user_id)
-        daily_stats = self.get_daily_stats(user_id)
-        weekly_stats = self.get_weekly_stats(user_id)
-        monthly_stats = self.get_monthly_stats(user_id)
-        transactions = self.get_user_transactions(user_id, 10)
+        # Порядок строк внутри UNION ALL не гарантирован
+        recent.sort(key=lambda item: item[0], reverse=True)
+        transactions = [tx for _, tx in recent]
+        daily_stats = periods["daily"]
+        weekly_stats = periods["weekly"]
+        monthly_stats = periods["monthly"]
         
         result = {
             'balance': balance,
@@ -242,8 +679,6 @@ class FinanceTracker:
             'monthlyStats': monthly_stats,
             'recentTransactions': transactions
         }
-        
-        logger.info(f"Статистика пользователя {user_id}: balance={balance}, transactions_count={len(transactions)}")
         return result
 
 # Инициализация трекера
@@ -252,43 +687,233 @@ tracker = FinanceTracker()
 # Категории для быстрого выбора
 EXPENSE_CATEGORIES = ["Кофе", "Заведение", "Одежда", "Косметика", "Транспорт", "Здоровье"]
 
-# Состояния пользователей
-user_states = {}
+# Неизменяемые клавиатуры строятся один раз при импорте.
+# В главной клавиатуре от пользователя зависит только кнопка веб-приложения.
+_MAIN_KB_ROWS = (
+    (KeyboardButton("📊 Баланс"), KeyboardButton("📈 Статистика")),
+    (KeyboardButton("💰 Добавить доход"), KeyboardButton("💸 Добавить расход")),
+    (KeyboardButton("❓ Помощь"),),
+)
+_STATS_KB = ReplyKeyboardMarkup([
+    [KeyboardButton("📅 За день"), KeyboardButton("📆 За неделю")],
+    [KeyboardButton("🗓️ За месяц")],
+    [KeyboardButton("🔙 Назад")]
+], resize_keyboard=True)
+_EXPENSE_KB = ReplyKeyboardMarkup(
+    [[KeyboardButton(cat)] for cat in EXPENSE_CATEGORIES] + [[KeyboardButton("🔙 Назад")]],
+    resize_keyboard=True
+)
+_BACK_KB = ReplyKeyboardMarkup([[KeyboardButton("🔙 Назад")]], resize_keyboard=True)
+_EXPENSE_CATEGORY_SET = frozenset(EXPENSE_CATEGORIES)
+
+# Тексты ответов
+_WELCOME_TEXT = """
+🏦 *Финансовый трекер*
+
+Привет! Я помогу тебе отслеживать доходы и расходы.
+
+*Доступные функции:*
+• Добавление доходов и расходов
+• Просмотр текущего баланса
+• Статистика за день, неделю и месяц
+• Категоризация транзакций
 
-def get_main_keyboard(user_id: int):
+Используй кнопки меню для навигации!
+"""
+
+_HELP_TEXT = """
+📖 *Как пользоваться ботом:*
+
+🚀 *Веб-приложение:*
+Нажми "🚀 Открыть приложение" для современного интерфейса
+
+*Добавление транзакций:*
+1. Нажми "💰 Добавить доход" или "💸 Добавить расход"
+2. Выбери категорию (для расходов)
+3. Введи сумму (например: 1500 или 1500 за обед)
+
+*Просмотр данных:*
+• "📊 Баланс" - текущий баланс
+• "📈 Статистика" - данные за день, неделю или месяц
+
+*Примеры ввода суммы:*
+• `1500`
+• `1500 зарплата`
+• `500 обед в кафе`
+"""
+
+_BALANCE_TEXT = "💰 *Текущий баланс:* {0:.2f} ₽{1}"
+_SYNC_DONE_TEXT = (
+    "✅ Синхронизация завершена!\n\n"
+    "📊 Добавлено транзакций: {0}\n"
+    "💰 Общий доход: {1:.2f} ₽\n"
+    "💸 Общий расход: {2:.2f} ₽\n\n"
+    "🔄 *Новый баланс: {3:.2f} ₽*"
+)
+
+_STATS_HEADER = "📈 *Статистика за {period}:*\n\n"
+_STATS_EMPTY = _STATS_HEADER + "📭 Нет транзакций за выбранный период"
+_STATS_SECTION = "{icon} *{title}:* {total:.2f} ₽\n"
+_STATS_LINE = "  • {0}: {1:.2f} ₽\n"
+_STATS_DIFFERENCE = "📊 *Разница:* {0:.2f} ₽"
+# (категории, итог, значок, заголовок) для разделов статистики
+_STATS_SECTIONS = (
+    ("income", "total_income", "💰", "Доходы"),
+    ("expense", "total_expense", "💸", "Расходы"),
+)
+
+def format_stats_text(stats: Dict[str, Any], period_text: str) -> str:
+    """Текст статистики за период"""
+    if stats["total_income"] == 0 and stats["total_expense"] == 0:
+        return _STATS_EMPTY.format(period=period_text)
+    
+    parts = [_STATS_HEADER.format(period=period_text)]
+    for key, total_key, icon, title in _STATS_SECTIONS:
+        if stats[total_key] > 0:
+            parts.append(_STATS_SECTION.format(icon=icon, title=title, total=stats[total_key]))
+            parts.extend(_STATS_LINE.format(category, amount) for category, amount in stats[key].items())
+            parts.append("\n")
+    
+    difference = stats["total_income"] - stats["total_expense"]
+    parts.append(_STATS_DIFFERENCE.format(difference))
+    
+    if difference > 0:
+        parts.append(" ✅")
+    elif difference < 0:
+        parts.append(" ❌")
+    
+    return "".join(parts)
+
+# Состояния пользователей: ограниченный кэш перед таблицей user_state.
+# Брошенные диалоги вытесняются через час, редкие пользователи — по LRU,
+# вытесненное состояние при следующем сообщении читается из базы
+class UserState:
+    """Состояние диалога пользователя; один объект на пользователя, меняется на месте"""
+    __slots__ = ("state", "category", "saved_at")
+    
+    def __init__(self, state: str = "main", category: str = None):
+        self.state = state
+        self.category = category
+        # Момент последней записи в user_state (time.monotonic), 0 - ещё не записывалось
+        self.saved_at = 0.0
+
+user_states: TTLCache = TTLCache(maxsize=CACHE_MAX_USERS, ttl=USER_STATE_TTL)
+
+async def get_state(user_id: int) -> UserState:
+    """Текущее состояние диалога пользователя"""
+    user_state = user_states.get(user_id)
+    if user_state is None:
+        saved = await asyncio.to_thread(tracker.load_user_state, user_id)
+        user_state = UserState(**saved) if saved else UserState()
+        user_states[user_id] = user_state
+    return user_state
+
+async def set_state(user_id: int, state: str, category: str = None):
+    """Смена состояния диалога; неизменное состояние пишется в базу не чаще раза в полпериода TTL"""
+    now = time.monotonic()
+    user_state = user_states.get(user_id)
+    if user_state is None:
+        user_state = UserState(state, category)
+    elif user_state.state == state and user_state.category == category:
+        if now - user_state.saved_at < USER_STATE_TTL / 2:
+            # Повторная вставка продлевает TTL активного диалога в памяти
+            user_states[user_id] = user_state
+            return
+    else:
+        user_state.state = state
+        user_state.category = category
+    # Повторная вставка продлевает TTL активного диалога, запись - updated_at в базе
+    user_states[user_id] = user_state
+    user_state.saved_at = now
+    await asyncio.to_thread(tracker.save_user_state, user_id, state, category)
+
+# Блокировки по пользователю: обновления одного чата обрабатываются по порядку,
+# разные чаты - параллельно (обработчики зарегистрированы с block=False)
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def per_user_ordered(handler):
+    """Сериализация обработки обновлений внутри одного чата"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        lock = _user_locks.get(user_id)
+        if lock is None:
+            lock = _user_locks[user_id] = asyncio.Lock()
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
+# Сумма и необязательное описание: "1500", "99,90 обед"
+_AMOUNT_RE = re.compile(r'^\s*(\d+(?:[.,]\d+)?)(?:\s+(.*))?$', re.DOTALL)
+
+def parse_amount(text: str) -> tuple[float, str]:
+    """Разбор введённой суммы и описания"""
+    # Быстрый путь для самого частого ввода — целой суммы без описания
+    if text.isascii() and text.isdigit():
+        return float(text), ""
+    m = _AMOUNT_RE.match(text)
+    if not m:
+        raise ValueError("Неверный формат суммы")
+    return float(m.group(1).replace(',', '.')), m.group(2) or ""
+
+# Обязательные поля транзакции из Web App
+_WEBAPP_REQUIRED_FIELDS = ('type', 'amount', 'category')
+
+def parse_webapp_transaction(item: Any) -> Dict[str, Any]:
+    """Проверка и приведение транзакции из Web App до обращения к базе"""
+    if not isinstance(item, dict):
+        raise ValueError("Неполные данные транзакции")
+    missing = [field for field in _WEBAPP_REQUIRED_FIELDS if item.get(field) is None]
+    if missing:
+        raise ValueError(f"Неполные данные транзакции: {', '.join(missing)}")
+    description = item.get('description') or ''
+    if not all(isinstance(value, str) for value in (item['type'], item['category'], description)):
+        raise ValueError("Неверный формат данных транзакции")
+    # bool — подкласс int, но суммой не является
+    if isinstance(item['amount'], bool):
+        raise ValueError("Неверный формат суммы")
+    try:
+        amount = float(item['amount'])
+    except (TypeError, ValueError):
+        raise ValueError("Неверный формат суммы") from None
+    return {
+        'type': item['type'],
+        'amount': amount,
+        'category': item['category'],
+        'description': description,
+    }
+
+async def get_main_keyboard(user_id: int):
     """Главная клавиатура с веб-приложением"""
-    webapp_url = get_webapp_url_with_data(user_id)
+    webapp_url = await asyncio.to_thread(get_webapp_url_with_data, user_id)
     
-    logger.info(f"🔧 Создание клавиатуры для пользователя {user_id}")
-    logger.info(f"🌐 Сгенерированный URL: {webapp_url}")
+    logger.debug("🔧 Создание клавиатуры для пользователя %s", user_id)
+    logger.debug("🌐 Сгенерированный URL: %s", webapp_url)
     
     keyboard = [
         [KeyboardButton("🚀 Открыть приложение", web_app=WebAppInfo(url=webapp_url))],
-        [KeyboardButton("📊 Баланс"), KeyboardButton("📈 Статистика")],
-        [KeyboardButton("💰 Добавить доход"), KeyboardButton("💸 Добавить расход")],
-        [KeyboardButton("❓ Помощь")]
+        *_MAIN_KB_ROWS
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def get_stats_keyboard():
-    """Клавиатура для выбора периода статистики"""
-    keyboard = [
-        [KeyboardButton("📅 За день"), KeyboardButton("📆 За неделю")],
-        [KeyboardButton("🗓️ За месяц")],
-        [KeyboardButton("🔙 Назад")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+# Готовые URL веб-приложения: user_id -> (статистика, по которой построен URL, URL).
+# Пока трекер отдаёт из кэша тот же объект статистики, URL не пересобирается;
+# запись транзакции или истечение TTL дают новый объект и новый URL
+_webapp_urls: LRUCache = LRUCache(maxsize=CACHE_MAX_USERS)
+_webapp_urls_lock = threading.Lock()
 
 def get_webapp_url_with_data(user_id: int) -> str:
     """Создание URL веб-приложения с данными пользователя"""
     try:
-        base_url = os.getenv("WEBAPP_URL", "https://your-username.github.io/your-repo-name/webapp.html")
-        
-        logger.info(f"Создание URL с данными для пользователя {user_id}")
-        
         user_stats = tracker.get_user_stats(user_id)
         
-        logger.debug(f"Данные пользователя для URL: {user_stats}")
+        with _webapp_urls_lock:
+            cached = _webapp_urls.get(user_id)
+        if cached is not None and cached[0] is user_stats:
+            return cached[1]
+        
+        logger.debug("Создание URL с данными для пользователя %s", user_id)
+        logger.debug("Данные пользователя для URL: %s", user_stats)
         
         balance = user_stats.get('balance', 0)
         daily_stats = user_stats.get('dailyStats', {})
@@ -323,301 +948,246 @@ def get_webapp_url_with_data(user_id: int) -> str:
             'balance': balance,
             'dailyIncome': daily_income,
             'dailyExpense': daily_expense,
-            'dailyExpenses': json.dumps(daily_expense_categories),
+            'dailyExpenses': orjson.dumps(daily_expense_categories),
             'weeklyIncome': weekly_income,
             'weeklyExpense': weekly_expense,
-            'weeklyExpenses': json.dumps(weekly_expense_categories),
+            'weeklyExpenses': orjson.dumps(weekly_expense_categories),
             'monthlyIncome': monthly_income,
             'monthlyExpense': monthly_expense,
-            'monthlyExpenses': json.dumps(monthly_expense_categories),
+            'monthlyExpenses': orjson.dumps(monthly_expense_categories),
             'timestamp': int(time.time()),
             'user_id': user_id
         }
         
         query_string = urllib.parse.urlencode(data)
-        final_url = f"{base_url}?{query_string}"
+        final_url = f"{WEBAPP_URL}?{query_string}"
         
-        logger.info(f"Создан уникальный URL: {final_url}")
+        with _webapp_urls_lock:
+            _webapp_urls[user_id] = (user_stats, final_url)
+        
+        logger.debug("Создан уникальный URL: %s", final_url)
         return final_url
         
     except Exception as e:
-        logger.error(f"Ошибка создания URL с данными: {e}")
-        return os.getenv("WEBAPP_URL", "https://your-username.github.io/your-repo-name/webapp.html")
-
-def get_category_keyboard(transaction_type: str):
-    """Клавиатура с категориями расходов"""
-    categories = EXPENSE_CATEGORIES
-    keyboard = [[KeyboardButton(cat)] for cat in categories]
-    keyboard.append([KeyboardButton("🔙 Назад")])
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        logger.error("Ошибка создания URL с данными: %s", e)
+        return WEBAPP_URL
 
+@per_user_ordered
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     user_id = update.effective_user.id
-    user_states[user_id] = {"state": "main"}
-    
-    welcome_text = """
-🏦 *Финансовый трекер*
-
-Привет! Я помогу тебе отслеживать доходы и расходы.
-
-*Доступные функции:*
-• Добавление доходов и расходов
-• Просмотр текущего баланса
-• Статистика за день, неделю и месяц
-• Категоризация транзакций
-
-Используй кнопки меню для навигации!
-"""
+    await set_state(user_id, "main")
     
     await update.message.reply_text(
-        welcome_text,
+        _WELCOME_TEXT,
         parse_mode="Markdown",
-        reply_markup=get_main_keyboard(user_id)
+        reply_markup=await get_main_keyboard(user_id)
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда помощи"""
-    help_text = """
-📖 *Как пользоваться ботом:*
-
-🚀 *Веб-приложение:*
-Нажми "🚀 Открыть приложение" для современного интерфейса
-
-*Добавление транзакций:*
-1. Нажми "💰 Добавить доход" или "💸 Добавить расход"
-2. Выбери категорию (для расходов)
-3. Введи сумму (например: 1500 или 1500 за обед)
-
-*Просмотр данных:*
-• "📊 Баланс" - текущий баланс
-• "📈 Статистика" - данные за день, неделю или месяц
-
-*Примеры ввода суммы:*
-• `1500`
-• `1500 зарплата`
-• `500 обед в кафе`
-"""
-    
-    await update.message.reply_text(help_text, parse_mode="Markdown")
+    await update.message.reply_text(_HELP_TEXT, parse_mode="Markdown", rate_limit_args=LOW_PRIORITY_RETRIES)
 
+@per_user_ordered
 async def refresh_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для обновления веб-приложения с актуальными данными"""
     user_id = update.effective_user.id
     
-    logger.info(f"Команда /refresh для пользователя {user_id}")
+    logger.info("Команда /refresh для пользователя %s", user_id)
     
-    user_stats = tracker.get_user_stats(user_id)
+    user_stats = await asyncio.to_thread(tracker.get_user_stats, user_id)
     balance = user_stats.get('balance', 0)
     
     await update.message.reply_text(
         f"🔄 *Данные обновлены через команду!*\n\n💰 Актуальный баланс: *{balance:.2f} ₽*",
         parse_mode="Markdown",
-        reply_markup=get_main_keyboard(user_id)
+        reply_markup=await get_main_keyboard(user_id)
     )
 
+async def save_transaction(update: Update, user_id: int, transaction_type: str, amount: float,
+                           category: str, description: str) -> bool:
+    """Запись транзакции; при ошибке базы сообщает пользователю и возвращает False"""
+    try:
+        await asyncio.to_thread(tracker.add_transaction, user_id, transaction_type, amount, category, description)
+    except sqlite3.Error as e:
+        # Строка откатена и не записана: повтор не создаст дубликат
+        logger.error("Ошибка записи транзакции пользователя %s: %s", user_id, e)
+        await update.message.reply_text("❌ Не удалось сохранить транзакцию, попробуй ещё раз")
+        return False
+    return True
+
+@per_user_ordered
 async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка данных из Web App"""
     try:
         user_id = update.effective_user.id
-        data = json.loads(update.effective_message.web_app_data.data)
+        data = orjson.loads(update.effective_message.web_app_data.data)
         
-        logger.info(f"Получены данные от Web App от пользователя {user_id}: {data}")
+        logger.info("Получены данные от Web App от пользователя %s: %s", user_id, data)
         
         # Проверяем, это одна транзакция или пакет
         if 'transactions' in data:
             # Обработка пакета транзакций (при синхронизации)
-            transactions = data['transactions']
-            total_income = 0
-            total_expense = 0
+            # Весь пакет проверяется до записи в базу
+            transactions = [parse_webapp_transaction(item) for item in data['transactions']]
+            total_income = sum(tx['amount'] for tx in transactions if tx['type'] == 'income')
+            total_expense = sum(tx['amount'] for tx in transactions if tx['type'] != 'income')
             
-            for transaction in transactions:
-                tracker.add_transaction(
-                    user_id=user_id,
-                    transaction_type=transaction['type'],
-                    amount=float(transaction['amount']),
-                    category=transaction['category'],
-                    description=transaction.get('description', '')
-                )
-                
-                if transaction['type'] == 'income':
-                    total_income += float(transaction['amount'])
-                else:
-                    total_expense += float(transaction['amount'])
+            # Весь пакет пишется одним executemany в одной транзакции
+            await asyncio.to_thread(tracker.add_transactions_bulk, user_id, transactions)
             
-            new_balance = tracker.get_user_balance(user_id)
+            new_balance = await asyncio.to_thread(tracker.get_user_balance, user_id)
             
             await update.message.reply_text(
-                f"✅ Синхронизация завершена!\n\n"
-                f"📊 Добавлено транзакций: {len(transactions)}\n"
-                f"💰 Общий доход: {total_income:.2f} ₽\n"
-                f"💸 Общий расход: {total_expense:.2f} ₽\n\n"
-                f"🔄 *Новый баланс: {new_balance:.2f} ₽*",
+                _SYNC_DONE_TEXT.format(len(transactions), total_income, total_expense, new_balance),
                 parse_mode="Markdown",
-                reply_markup=get_main_keyboard(user_id)
+                reply_markup=await get_main_keyboard(user_id)
             )
             
         else:
             # Обработка одной транзакции (старый формат для совместимости)
-            if 'type' not in data or 'amount' not in data or 'category' not in data:
-                raise ValueError("Неполные данные транзакции")
+            transaction = parse_webapp_transaction(data)
             
-            tracker.add_transaction(
+            # Вставка и чтение итогов выполняются одной транзакцией SQLite
+            stats = await asyncio.to_thread(
+                tracker.add_transaction_and_get_stats,
                 user_id=user_id,
-                transaction_type=data['type'],
-                amount=float(data['amount']),
-                category=data['category'],
-                description=data.get('description', '')
+                transaction_type=transaction['type'],
+                amount=transaction['amount'],
+                category=transaction['category'],
+                description=transaction['description']
             )
             
-            new_balance = tracker.get_user_balance(user_id)
+            new_balance = stats['balance']
             
-            transaction_type_text = "Доход" if data['type'] == 'income' else "Расход"
+            transaction_type_text = "Доход" if transaction['type'] == 'income' else "Расход"
             await update.message.reply_text(
                 f"✅ {transaction_type_text} добавлен через приложение!\n\n"
-                f"💰 {data['amount']:.2f} ₽\n"
-                f"📂 {data['category']}\n"
-                f"📝 {data.get('description', '')}\n\n"
+                f"💰 {transaction['amount']:.2f} ₽\n"
+                f"📂 {transaction['category']}\n"
+                f"📝 {transaction['description']}\n\n"
                 f"🔄 *Новый баланс: {new_balance:.2f} ₽*",
                 parse_mode="Markdown",
-                reply_markup=get_main_keyboard(user_id)
+                reply_markup=await get_main_keyboard(user_id)
             )
         
     except Exception as e:
-        logger.error(f"Ошибка обработки Web App данных: {e}", exc_info=True)
+        logger.error("Ошибка обработки Web App данных: %s", e, exc_info=True)
         await update.message.reply_text("❌ Ошибка при обработке данных приложения")
         
+async def _income_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Кнопка "Добавить доход" """
+    await set_state(user_id, "enter_income_amount")
+    await update.message.reply_text(
+        "💰 Введи сумму дохода:",
+        reply_markup=_BACK_KB
+    )
+
+async def _expense_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Кнопка "Добавить расход" """
+    await set_state(user_id, "select_expense_category")
+    await update.message.reply_text(
+        "Выбери категорию расхода:",
+        reply_markup=_EXPENSE_KB
+    )
+
+async def _balance_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Кнопка "Баланс" """
+    balance = await asyncio.to_thread(tracker.get_user_balance, user_id)
+    mark = " ✅" if balance > 0 else " ❌" if balance < 0 else " ⚖️"
+    await update.message.reply_text(_BALANCE_TEXT.format(balance, mark), parse_mode="Markdown")
+
+async def _stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Кнопка "Статистика" """
+    await set_state(user_id, "select_stats_period")
+    await update.message.reply_text(
+        "📊 Выбери период для статистики:",
+        reply_markup=_STATS_KB
+    )
+
+async def _help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Кнопка "Помощь" """
+    await help_command(update, context)
+
+# Кнопки главного меню -> обработчики
+_MAIN_HANDLERS = {
+    "💰 Добавить доход": _income_handler,
+    "💸 Добавить расход": _expense_handler,
+    "📊 Баланс": _balance_handler,
+    "📈 Статистика": _stats_handler,
+    "❓ Помощь": _help_handler,
+}
+
+# Кнопка периода -> (метод трекера, период в заголовке статистики)
+_STATS_PERIODS = {
+    "📅 За день": (tracker.get_daily_stats, "день"),
+    "📆 За неделю": (tracker.get_weekly_stats, "неделю"),
+    "🗓️ За месяц": (tracker.get_monthly_stats, "месяц"),
+}
+
+@per_user_ordered
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка сообщений"""
     user_id = update.effective_user.id
     text = update.message.text
     
-    if user_id not in user_states:
-        user_states[user_id] = {"state": "main"}
-    
-    state = user_states[user_id]["state"]
+    user_state = await get_state(user_id)
+    state = user_state.state
     
     if text == "🔙 Назад":
-        user_states[user_id] = {"state": "main"}
+        await set_state(user_id, "main")
         await update.message.reply_text(
             "Главное меню:",
-            reply_markup=get_main_keyboard(user_id)
+            reply_markup=await get_main_keyboard(user_id)
         )
         return
     
     if state == "main":
-        if text == "💰 Добавить доход":
-            user_states[user_id] = {"state": "enter_income_amount"}
-            await update.message.reply_text(
-                "💰 Введи сумму дохода:",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton("🔙 Назад")]], resize_keyboard=True)
-            )
-            
-        elif text == "💸 Добавить расход":
-            user_states[user_id] = {"state": "select_expense_category"}
-            await update.message.reply_text(
-                "Выбери категорию расхода:",
-                reply_markup=get_category_keyboard("expense")
-            )
-            
-        elif text == "📊 Баланс":
-            balance = tracker.get_user_balance(user_id)
-            balance_text = f"💰 *Текущий баланс:* {balance:.2f} ₽"
-            
-            if balance > 0:
-                balance_text += " ✅"
-            elif balance < 0:
-                balance_text += " ❌"
-            else:
-                balance_text += " ⚖️"
-                
-            await update.message.reply_text(balance_text, parse_mode="Markdown")
-            
-        elif text == "📈 Статистика":
-            user_states[user_id] = {"state": "select_stats_period"}
-            await update.message.reply_text(
-                "📊 Выбери период для статистики:",
-                reply_markup=get_stats_keyboard()
-            )
-            
-        elif text == "❓ Помощь":
-            await help_command(update, context)
+        handler = _MAIN_HANDLERS.get(text)
+        if handler:
+            await handler(update, context, user_id)
     
     elif state == "select_stats_period":
-        if text == "📅 За день":
-            stats = tracker.get_daily_stats(user_id)
-            period_text = "день"
-            
-        elif text == "📆 За неделю":
-            stats = tracker.get_weekly_stats(user_id)
-            period_text = "неделю"
-            
-        elif text == "🗓️ За месяц":
-            stats = tracker.get_monthly_stats(user_id)
-            period_text = "месяц"
-            
-        else:
+        period = _STATS_PERIODS.get(text)
+        if period is None:
             return
         
-        # Формируем текст статистики
-        stats_text = f"📈 *Статистика за {period_text}:*\n\n"
-        
-        if stats["total_income"] > 0:
-            stats_text += f"💰 *Доходы:* {stats['total_income']:.2f} ₽\n"
-            for category, amount in stats["income"].items():
-                stats_text += f"  • {category}: {amount:.2f} ₽\n"
-            stats_text += "\n"
-        
-        if stats["total_expense"] > 0:
-            stats_text += f"💸 *Расходы:* {stats['total_expense']:.2f} ₽\n"
-            for category, amount in stats["expense"].items():
-                stats_text += f"  • {category}: {amount:.2f} ₽\n"
-            stats_text += "\n"
-        
-        difference = stats["total_income"] - stats["total_expense"]
-        stats_text += f"📊 *Разница:* {difference:.2f} ₽"
-        
-        if difference > 0:
-            stats_text += " ✅"
-        elif difference < 0:
-            stats_text += " ❌"
-        
-        if stats["total_income"] == 0 and stats["total_expense"] == 0:
-            stats_text = f"📈 *Статистика за {period_text}:*\n\n📭 Нет транзакций за выбранный период"
-        
+        get_stats, period_text = period
+        stats = await asyncio.to_thread(get_stats, user_id)
         await update.message.reply_text(
-            stats_text, 
+            format_stats_text(stats, period_text), 
             parse_mode="Markdown", 
-            reply_markup=get_main_keyboard(user_id)
+            reply_markup=await get_main_keyboard(user_id),
+            rate_limit_args=LOW_PRIORITY_RETRIES
         )
-        user_states[user_id] = {"state": "main"}
+        await set_state(user_id, "main")
     
     elif state == "select_expense_category":
-        if text in EXPENSE_CATEGORIES:
-            user_states[user_id] = {"state": "enter_expense_amount", "category": text}
+        if text in _EXPENSE_CATEGORY_SET:
+            await set_state(user_id, "enter_expense_amount", category=text)
             await update.message.reply_text(
                 f"💸 Категория: *{text}*\n\nВведи сумму расхода:",
                 parse_mode="Markdown",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton("🔙 Назад")]], resize_keyboard=True)
+                reply_markup=_BACK_KB
             )
     
     elif state == "enter_income_amount":
         try:
-            parts = text.split(maxsplit=1)
-            amount = float(parts[0])
-            description = parts[1] if len(parts) > 1 else ""
+            amount, description = parse_amount(text)
             
-            tracker.add_transaction(user_id, "income", amount, "Доход", description)
+            # Ответ об успехе отправляется только после записи строки в базу
+            if not await save_transaction(update, user_id, "income", amount, "Доход", description):
+                return
             
-            new_balance = tracker.get_user_balance(user_id)
-            logger.info(f"🔄 После добавления дохода: новый баланс = {new_balance}")
+            new_balance = await asyncio.to_thread(tracker.get_user_balance, user_id)
+            logger.debug("🔄 После добавления дохода: новый баланс = %s", new_balance)
             
             await update.message.reply_text(
                 f"✅ Доход добавлен!\n\n💰 *{amount:.2f} ₽*\n📝 {description}",
                 parse_mode="Markdown",
-                reply_markup=get_main_keyboard(user_id)
+                reply_markup=await get_main_keyboard(user_id)
             )
-            user_states[user_id] = {"state": "main"}
+            await set_state(user_id, "main")
             
         except ValueError as e:
             await update.message.reply_text(
@@ -627,19 +1197,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif state == "enter_expense_amount":
         try:
-            parts = text.split(maxsplit=1)
-            amount = float(parts[0])
-            description = parts[1] if len(parts) > 1 else ""
+            amount, description = parse_amount(text)
             
-            category = user_states[user_id]["category"]
-            tracker.add_transaction(user_id, "expense", amount, category, description)
+            category = user_state.category
+            if not await save_transaction(update, user_id, "expense", amount, category, description):
+                return
             
             await update.message.reply_text(
                 f"✅ Расход добавлен!\n\n💸 *{amount:.2f} ₽*\n📂 {category}\n📝 {description}",
                 parse_mode="Markdown",
-                reply_markup=get_main_keyboard(user_id)
+                reply_markup=await get_main_keyboard(user_id)
             )
-            user_states[user_id] = {"state": "main"}
+            await set_state(user_id, "main")
             
         except ValueError as e:
             await update.message.reply_text(
@@ -647,6 +1216,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="Markdown"
             )
 
+async def post_shutdown(application: Application):
+    """Закрытие базы и остановка записи логов"""
+    await asyncio.to_thread(tracker.close)
+    log_listener.stop()
+
 def main():
     """Запуск бота"""
     if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
@@ -655,19 +1229,33 @@ def main():
         return
     
     print("🤖 Инициализация бота...")
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=SEND_MAX_RETRIES))
+        .request(HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE, http_version="2", pool_timeout=1.0))
+        .get_updates_request(HTTPXRequest(connection_pool_size=8))
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Добавление обработчиков
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("refresh", refresh_command))
-    application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
-    application.add_handler(MessageHandler(filters.TEXT, handle_message))
+    # block=False: каждое обновление - отдельная задача, медленный чат не задерживает остальные
+    application.add_handler(CommandHandler("start", start, block=False))
+    application.add_handler(CommandHandler("help", help_command, block=False))
+    application.add_handler(CommandHandler("refresh", refresh_command, block=False))
+    application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data, block=False))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
     
     print("🤖 Бот запущен!")
     print(f"📁 База данных: {DATABASE_PATH}")
     print("📨 Ожидание сообщений...")
     
+    # Быстрый цикл событий на libuv, если установлен. run_polling берёт текущий цикл
+    # через get_event_loop(); uvloop.install() устарел начиная с Python 3.12
+    if uvloop is not None:
+        asyncio.set_event_loop(uvloop.new_event_loop())
+    
     # Запускаем бота
     application.run_polling()
 